@@ -34,8 +34,11 @@ class GzipWorker(BaseWorker):
   def header(self):
     return GZIP_HEADER
 
+  def update(self, chunk):
+    self.crc = zlib.crc32(chunk, self.crc)
+
   def suffix(self):
-    return struct.pack('<II', zlib.crc32(self.raw_data) & 0xFFFFFFFF, self.fsize)
+    return struct.pack('<II', self.crc & 0xFFFFFFFF, self.fsize)
 
 class Gzip(ZpyZpr):
   def __init__(self, **kwargs):
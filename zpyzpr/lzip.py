@@ -37,17 +37,22 @@ class LzmaCompObj:
     return ''
 
 class LzipWorker(BaseWorker):
+  # pylzma can only compress a whole string, so take the block in one view
+  sub_chunk = None
+
   def get_compobj(self):
     return LzmaCompObj()
 
   def header(self):
     return LZIP_HEADER
 
+  def update(self, chunk):
+    self.crc = binascii.crc32(chunk, self.crc)
+
   def suffix(self):
-    crc = binascii.crc32(self.raw_data)
     # member size includes header and trailer
     # header is 6 bytes, trailer is 20
-    return struct.pack('<IQQ', crc & 0xffffffff, self.fsize, len(self.data)+6+20)
+    return struct.pack('<IQQ', self.crc & 0xffffffff, self.fsize, self.size+6+20)
 
 class Lzip(ZpyZpr):
   def __init__(self, **kwargs):
@@ -22,7 +22,9 @@
 # OTHER DEALINGS IN THE SOFTWARE
 
 from datetime import datetime
-import os, sys, signal
+import os, sys, signal, select, time, stat, threading
+import Queue as ChunkQueue
+from collections import deque
 
 try:
   from multiprocessing import Process as Thread, Queue, Pipe
@@ -54,14 +56,243 @@ except Exception, ex:
 
 CHUNK_SIZE_BYTES = 1024000 # 1000K
 BLOCK_SIZE = 1024
+READ_AHEAD_DEPTH = 16
+SUB_CHUNK_BYTES = 262144 # 256K
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+CPU_SETSIZE = 1024
+
+try:
+  import ctypes, ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except Exception, ex:
+  _libc = None
+
+try:
+  posix_fadvise = os.posix_fadvise
+except AttributeError:
+  try:
+    _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    def posix_fadvise(fd, offset, length, advice):
+      return _libc.posix_fadvise(fd, offset, length, advice)
+  except Exception, ex:
+    def posix_fadvise(fd, offset, length, advice):
+      return 0
+
+def parse_cpulist(cpulist):
+  """Expands a kernel cpu list such as '0-3,8,10-11'"""
+  cpus = []
+  for part in cpulist.strip().split(','):
+    if not part: continue
+    if '-' in part:
+      (first, last) = part.split('-')
+      cpus.extend(range(int(first), int(last)+1))
+    else:
+      cpus.append(int(part))
+  return cpus
+
+def read_first_line(path):
+  try:
+    f = open(path)
+    try:
+      return f.readline().strip()
+    finally:
+      f.close()
+  except (IOError, OSError):
+    return None
+
+def allowed_cpus():
+  """
+  The cpus this process may run on according to its affinity mask,
+  or None when that can't be determined.
+  """
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+
+  try:
+    f = open('/proc/self/status')
+    try:
+      for line in f:
+        if line.startswith('Cpus_allowed_list:'):
+          return parse_cpulist(line.split(':', 1)[1])
+    finally:
+      f.close()
+  except (IOError, OSError):
+    pass
+  return None
+
+def cgroup_cpu_limit():
+  """
+  Number of cpus worth of time granted by a cgroup v2 cpu.max or v1
+  cfs quota, or None when there is no quota.
+  """
+  quota = period = None
+
+  line = read_first_line('/sys/fs/cgroup/cpu.max')
+  if line:
+    (quota, period) = line.split()
+    if quota == 'max': return None
+  else:
+    for base in ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct'):
+      quota = read_first_line(os.path.join(base, 'cpu.cfs_quota_us'))
+      period = read_first_line(os.path.join(base, 'cpu.cfs_period_us'))
+      if quota and period: break
+
+  if not quota or not period: return None
+
+  (quota, period) = (int(quota), int(period))
+  if quota <= 0 or period <= 0: return None
+
+  # round partial cpus up, a 1.5 cpu quota can keep two workers busy
+  return max(1, (quota + period - 1) // period)
+
+def numa_nodes():
+  """The cpu lists of each NUMA node, empty when not available"""
+  nodes = []
+  base = '/sys/devices/system/node'
+  try:
+    names = os.listdir(base)
+  except OSError:
+    return nodes
+
+  names = [n for n in names if n.startswith('node') and n[4:].isdigit()]
+  names.sort(key=lambda n: int(n[4:]))
+  for name in names:
+    line = read_first_line(os.path.join(base, name, 'cpulist'))
+    if line: nodes.append(parse_cpulist(line))
+  return nodes
+
+def set_affinity(cpus):
+  """Restricts the calling process (or thread) to the given cpus"""
+  if hasattr(os, 'sched_setaffinity'):
+    return os.sched_setaffinity(0, cpus)
+
+  if not _libc or not hasattr(_libc, 'sched_setaffinity'): return
+
+  bits = ctypes.sizeof(ctypes.c_ulong) * 8
+  mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+  for cpu in cpus:
+    mask[cpu // bits] |= 1 << (cpu % bits)
+
+  if _libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+def read_checkpoint(path):
+  """
+  The (input offset, output offset) of the last complete entry in a
+  compression journal, or (0, 0) when there is none.
+  """
+  checkpoint = (0, 0)
+  try:
+    f = open(path, 'rb')
+  except IOError:
+    return checkpoint
+
+  try:
+    for line in f:
+      # a torn final line from a crash mid-write is ignored
+      if not line.endswith('\n'): break
+      (input_offset, output_offset) = line.split()
+      checkpoint = (int(input_offset), int(output_offset))
+  finally:
+    f.close()
+  return checkpoint
+
+class ReadAhead:
+  """
+  File-like wrapper that fills a bounded queue with large reads from a
+  background thread, so the next block is in memory when a worker goes idle.
+  Regular files are read with sequential and drop-behind hints so a big
+  compression doesn't push everything else out of the page cache.
+  """
+  def __init__(self, source, chunk_size=CHUNK_SIZE_BYTES, depth=READ_AHEAD_DEPTH):
+    self.source = source
+    self.chunk_size = chunk_size
+    self.chunks = ChunkQueue.Queue(depth)
+    self.pieces = deque()
+    self.buffered = 0
+    self.eof = False
+    self.fd = None
+
+    try:
+      fd = source.fileno()
+      if stat.S_ISREG(os.fstat(fd).st_mode):
+        self.fd = fd
+        posix_fadvise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, IOError):
+      pass
+
+    self.thread = threading.Thread(target=self.__fill)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+  def __fill(self):
+    try:
+      offset = self.source.tell()
+    except (AttributeError, IOError):
+      offset = 0
+
+    try:
+      while True:
+        data = self.source.read(self.chunk_size)
+        if self.fd is not None and data:
+          # the data now lives in our memory, the cached pages can go
+          posix_fadvise(self.fd, offset, len(data), POSIX_FADV_DONTNEED)
+          offset += len(data)
+        self.chunks.put(data)
+        if data == '': break
+    except Exception, ex:
+      self.chunks.put(ex)
+
+  def read(self, size):
+    while self.buffered < size and not self.eof:
+      data = self.chunks.get()
+      if isinstance(data, Exception):
+        self.eof = True
+        raise data
+      elif data == '':
+        self.eof = True
+      else:
+        self.pieces.append(data)
+        self.buffered += len(data)
+
+    # hand whole pieces over as they are, only the last one may need a slice
+    out = []
+    wanted = size
+    while wanted > 0 and self.pieces:
+      piece = self.pieces[0]
+      if len(piece) <= wanted:
+        out.append(self.pieces.popleft())
+        wanted -= len(piece)
+      else:
+        out.append(piece[:wanted])
+        self.pieces[0] = piece[wanted:]
+        wanted = 0
+    self.buffered -= size - wanted
+
+    if len(out) == 1:
+      return out[0]
+    else:
+      return ''.join(out)
+
+  def close(self):
+    return self.source.close()
 
 class BaseWorker(Thread):
-  def __init__(self, threadid, compression, queue, pipe):
+  sub_chunk = SUB_CHUNK_BYTES
+
+  def __init__(self, threadid, compression, queue, pipe, cpus=None, nice=None, parent=None):
     Thread.__init__(self)
     self.threadid = threadid
     self.comp = compression
     self.queue = queue
     self.pipe = pipe
+    self.parent = parent
+    self.cpus = cpus
+    self.nice = nice
 
   def header(self):
     return ''
@@ -69,6 +300,9 @@ class BaseWorker(Thread):
   def suffix(self):
     return ''
 
+  def update(self, chunk):
+    pass
+
   def get_item(self):
     try:
       item = self.pipe.recv()
@@ -78,36 +312,67 @@ class BaseWorker(Thread):
       else:
         return item
     except EOFError:
+      # the parent went away, e.g. killed before it could send STOP,
+      # nobody will read what's left in the queue so don't wait on it
+      self.running = False
+      if hasattr(self.queue, 'cancel_join_thread'): self.queue.cancel_join_thread()
       return None
 
   def run(self):
+    # drop our inherited copy of the parent's end so recv sees EOF if it dies
+    if self.parent and self.parent is not self.pipe: self.parent.close()
+    if self.cpus: set_affinity(self.cpus)
+    if self.nice: os.nice(self.nice)
+
     self.running = True
     while self.running:
       item = self.get_item()
       if item:
-        (self.raw_data, place) = item
-        self.fsize = len(self.raw_data)
-
+        (raw_data, place) = item
+        item = None
+        self.fsize = len(raw_data)
+        self.size = 0
+        self.crc = 0
+        self.data = []
+
+        # compress and checksum in one pass without copying the input
         compobj = self.get_compobj()
-        self.data = compobj.compress(self.raw_data)
-        self.data += compobj.flush()
+        step = self.sub_chunk or max(self.fsize, 1)
+        for offset in xrange(0, self.fsize, step):
+          chunk = buffer(raw_data, offset, step)
+          self.update(chunk)
+          self.append(compobj.compress(chunk))
+          chunk = None
+        raw_data = None
+        self.append(compobj.flush())
 
         self.queue.put((self.threadid, place, self.header(), self.suffix(), self.data))
         self.data = None
-        self.raw_data = None
+
+  def append(self, data):
+    if data:
+      self.data.append(data)
+      self.size += len(data)
 
 class ZpyZpr:
   def __init__(self, worker=None, threads=None,
                      block_size=CHUNK_SIZE_BYTES, compression=6,
-                     debug=False, logger=sys.stderr):
+                     debug=False, logger=sys.stderr,
+                     max_latency=None, line_blocks=False,
+                     pin=None, nice=None,
+                     journal=None, input_offset=0, output_offset=0):
     self.event_queue = Queue()
     self.completed = {}
+    self.lengths = {}
     self.last_completed = -1
     self.next_place = 0
     self.total_read = 0
     self.threads = []
     self.idle_threads = []
     self.eof_reached = False
+    self.carry = ''
+    self.carry_time = None
+    self.result_file = None
 
     self.thread_count = threads
     self.debug = debug
@@ -115,6 +380,13 @@ class ZpyZpr:
     self.compression = compression
     self.worker = worker
     self.logger = logger
+    self.max_latency = max_latency
+    self.line_blocks = line_blocks
+    self.pin = pin
+    self.nice = nice
+    self.journal = journal
+    self.input_offset = input_offset
+    self.output_offset = output_offset
 
     if not self.thread_count: self.thread_count = self.processor_count()
 
@@ -122,56 +394,108 @@ class ZpyZpr:
 
     if not self.block_size: self.block_size = CHUNK_SIZE_BYTES
 
+    placement = self.cpu_placement(self.pin)
+
     for i in range(self.thread_count):
       threadid = len(self.threads)
       (parent, client) = Pipe()
-      t = self.worker(threadid, self.compression, self.event_queue, client)
+      cpus = None
+      if placement: cpus = placement[i % len(placement)]
+      t = self.worker(threadid, self.compression, self.event_queue, client, cpus, self.nice, parent)
       self.threads.append((t, parent))
       t.start()
       self.idle_threads.append(threadid)
 
   def flush(self, err=False):
+    self.__stop_workers()
+    if not err and self.result_file: self.__combine()
+
+  def cancel(self):
+    """
+    Stop the workers and throw away any blocks that haven't been returned,
+    for callers that give up partway through a stream.
+    """
+    self.__stop_workers()
+    self.completed = {}
+    self.lengths = {}
+
+  def __stop_workers(self):
     self.log(self.debug, 'Joining all threads')
     for t,p in self.threads:
       p.send('STOP')
       p.close()
-      t.join()
 
-    if not err: self.__combine()
+    # a worker can't exit while its result is stuck in event_queue
+    for t,p in self.threads:
+      # processing and threading before 2.6 only have isAlive
+      alive = getattr(t, 'is_alive', None) or t.isAlive
+      while alive():
+        self.__run_queue(0.05)
+        t.join(0.05)
+    self.__run_queue(0)
+    self.threads = []
 
-  def __get_item(self):
+  def __get_item(self, timeout):
     try:
-      e = self.event_queue.get(timeout=0.20)
-      return e
+      if timeout:
+        return self.event_queue.get(timeout=timeout)
+      else:
+        return self.event_queue.get_nowait()
     except Empty:
       return None
 
-  def __run_queue(self):
-    item = self.__get_item()
+  def __run_queue(self, timeout=0.20):
+    item = self.__get_item(timeout)
     while item:
       (threadid, place, header, suffix, data) = item
       self.log(self.debug, 'Thread %d Completed Piece %d' % (threadid, place+1))
       self.completed[place] = (header, suffix, data)
       self.idle_threads.append(threadid)
-      self.__combine()
-      self.__send_next_block()
-      item = self.__get_item()
+      item = self.__get_item(0)
 
   def __send_next_block(self):
     count = len(self.idle_threads)
     while count > 0:
       count -= 1
-      threadid = self.idle_threads.pop()
       data = self.__read_next()
       if data:
-        place = self.next_place
-        self.log(self.debug, 'Thread %d Started Piece %d' % (threadid, place+1))
-        self.threads[threadid][1].send((data, place))
-        self.next_place += 1
+        self.feed(data)
+        # a short block means the stream went quiet, go write what's done
+        if self.max_latency and len(data) < self.block_size: break
       else:
-        self.idle_threads.append(threadid)
+        break
+
+  def feed(self, data):
+    """
+    Hand a block of raw data to an idle worker without waiting. Returns False
+    when every worker is busy, poll() for finished members and try again.
+    """
+    if not self.idle_threads: return False
+
+    threadid = self.idle_threads.pop()
+    place = self.next_place
+    self.log(self.debug, 'Thread %d Started Piece %d' % (threadid, place+1))
+    self.threads[threadid][1].send((data, place))
+    self.lengths[place] = len(data)
+    self.next_place += 1
+    return True
+
+  def poll(self, timeout=0):
+    """
+    Collect finished pieces and return the compressed members that are ready
+    to be written, in order. Waits at most timeout seconds for a piece.
+    """
+    self.__run_queue(timeout)
+    return [''.join([header] + data + [suffix]) for (header, suffix, data) in self.__ready()]
+
+  def pending(self):
+    """Number of blocks fed to workers that have not been returned in order"""
+    return self.next_place - 1 - self.last_completed
 
   def __read_next(self):
+    if self.max_latency and hasattr(self.source, 'fileno'):
+      return self.__read_bounded()
+
     data = self.source.read(self.block_size)
     self.total_read += len(data)
 
@@ -182,6 +506,56 @@ class ZpyZpr:
       self.log(self.debug, 'Read another %d (%d total read)' % (len(data), self.total_read))
       return data
 
+  def __read_bounded(self):
+    """
+    Read at most block_size bytes, giving up max_latency seconds after the
+    first byte of the block arrived so quiet streams still produce output.
+    Returns None when nothing has arrived yet without marking end of stream.
+    """
+    fd = self.source.fileno()
+    data = self.carry
+    self.carry = ''
+    # when each read started within data, to date a carried partial line
+    arrivals = []
+    if data:
+      arrivals.append((0, self.carry_time))
+      deadline = self.carry_time + self.max_latency
+    else:
+      # don't hold up finished members for long while the stream is quiet
+      deadline = time.time() + min(self.max_latency, 0.20)
+
+    while len(data) < self.block_size:
+      remaining = deadline - time.time()
+      if remaining <= 0: break
+
+      (readable, w, x) = select.select([fd], [], [], remaining)
+      if not readable: break
+
+      piece = os.read(fd, self.block_size - len(data))
+      if piece == '':
+        self.eof_reached = True
+        break
+
+      now = time.time()
+      if data == '': deadline = now + self.max_latency
+      arrivals.append((len(data), now))
+      data += piece
+      self.total_read += len(piece)
+
+    if self.line_blocks and not self.eof_reached and len(data) < self.block_size:
+      # keep a trailing partial line for the next block
+      end = data.rfind('\n') + 1
+      if end > 0:
+        self.carry = data[end:]
+        self.carry_time = [t for (offset, t) in arrivals if offset <= end][-1]
+        data = data[:end]
+
+    if data == '':
+      return None
+    else:
+      self.log(self.debug, 'Read another %d (%d total read)' % (len(data), self.total_read))
+      return data
+
   def __still_reading(self):
     # Succintly put
     #return not self.eof_reached or self.last_completed < self.next_place-1
@@ -200,32 +574,109 @@ class ZpyZpr:
 
     while self.__still_reading():
       self.__run_queue()
+      self.__combine()
+      self.__send_next_block()
+
+  def compressIter(self, source):
+    """
+    Generator yielding each compressed member as soon as it and every member
+    before it are finished. New blocks are only read from source while the
+    consumer is pulling, so a slow writer holds back the workers.
+    """
+    self.source = source
+
+    try:
       self.__send_next_block()
 
+      while self.__still_reading():
+        self.__run_queue()
+        for (header, suffix, data) in self.__ready():
+          yield ''.join([header] + data + [suffix])
+        self.__send_next_block()
+    finally:
+      # the consumer stopped early, e.g. the client went away
+      if self.__still_reading(): self.cancel()
+
   def log(self, display, message):
     if display: self.logger.write('[%s] %s%s' % (datetime.now(), message, os.linesep))
 
-  def __combine(self):
+  def __ready(self):
     next_block = self.last_completed + 1
 
     while(self.completed.has_key(next_block)):
       t = self.completed[next_block]
       del self.completed[next_block]
       (header, suffix, data) = t
-      t = None
+      self.input_offset += self.lengths.pop(next_block)
+      self.output_offset += len(header) + sum([len(piece) for piece in data]) + len(suffix)
+      data = None
       self.log(self.debug, "Combined %s" % (next_block+1))
+      self.last_completed = next_block
+      next_block += 1
+      yield t
+      t = None
+
+  def __combine(self):
+    for (header, suffix, data) in self.__ready():
       src = self.result_file
       src.write(header)
-      src.write(data)
+      for piece in data:
+        src.write(piece)
       src.write(suffix)
+      if self.max_latency: src.flush()
+      if self.journal: self.__checkpoint()
+
       data = None
       del data
 
-      self.last_completed = next_block
-      next_block += 1
+  def __checkpoint(self):
+    # the member must be on disk before the journal may point past it
+    self.result_file.flush()
+    os.fsync(self.result_file.fileno())
+    self.journal.write('%d %d\n' % (self.input_offset, self.output_offset))
+    self.journal.flush()
+    os.fsync(self.journal.fileno())
+
+  @staticmethod
+  def cpu_placement(pin):
+    """
+    The cpu sets workers are pinned to in turn, one per allowed cpu for
+    'cpu' and one per NUMA node for 'numa'.
+    """
+    if not pin: return None
+
+    cpus = allowed_cpus()
+    if not cpus: return None
+
+    if pin == 'cpu':
+      return [[cpu] for cpu in cpus]
+    elif pin == 'numa':
+      nodes = [[cpu for cpu in node if cpu in cpus] for node in numa_nodes()]
+      nodes = [node for node in nodes if node]
+      return nodes or [cpus]
+    else:
+      raise Exception('Unknown cpu pinning %s, expected cpu or numa' % pin)
 
   @staticmethod
   def processor_count():
+   """
+   Detects the number of CPUs this process may actually use, honouring the
+   affinity mask and any cgroup cpu quota before falling back to the number
+   of online CPUs.
+   """
+   cpus = allowed_cpus()
+   limit = cgroup_cpu_limit()
+   if cpus and limit:
+       return min(len(cpus), limit)
+   elif cpus:
+       return len(cpus)
+   elif limit:
+       return min(ZpyZpr.online_processor_count(), limit)
+   else:
+       return ZpyZpr.online_processor_count()
+
+  @staticmethod
+  def online_processor_count():
    """
    Detects the number of CPUs on a system. Cribbed from pp.
    From http://codeliberates.blogspot.com/2008/05/detecting-cpuscores-in-python.html
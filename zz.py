@@ -23,8 +23,11 @@
 # OTHER DEALINGS IN THE SOFTWARE
 
 from zpyzpr import MULTIPROCESSING
+from zpyzpr.zpyzpr import ReadAhead, read_checkpoint
 from datetime import datetime
-import getopt, os, sys, traceback
+import getopt, os, sys, traceback, subprocess
+
+WRITE_BUFFER_BYTES = 8 * 1024 * 1024
 
 try:
   from zpyzpr.gzip import Gzip
@@ -46,14 +49,22 @@ except:
 
 class ZpyZprOpts:
   def __init__(self, argv):
-    sopt = '123456789cb:hjkt:vzTl'
-    lopt = ['help', 'keep', 'verbose', 'timing', 'gzip', 'bzip2', 'blocks=', 'compression=', 'threads=', 'stdin', 'lzip']
+    sopt = '123456789cb:hjkt:vzTlL:'
+    lopt = ['help', 'keep', 'verbose', 'timing', 'gzip', 'bzip2', 'blocks=', 'compression=', 'threads=', 'stdin', 'lzip',
+            'latency=', 'lines', 'pin=', 'nice=', 'ionice=', 'journal', 'resume']
     self.verbose     = False
     self.timing      = False
     self.blocks      = None # Automaticly determined
     self.keep        = False
     self.compression = 6
     self.stdin       = False
+    self.latency     = None
+    self.lines       = False
+    self.pin         = None
+    self.nice        = None
+    self.ionice      = None
+    self.journal     = None
+    self.resume      = False
     self.source      = None
     self.destination = None
 
@@ -67,7 +78,7 @@ class ZpyZprOpts:
       sys.stderr.write('No compression libraries available.' + os.linesep)
       sys.exit(2)
 
-    self.threads     = self.worker.processor_count()+1 # Should this be determined magically?
+    self.threads     = self.worker.processor_count()
 
     try:
       opts, args = getopt.getopt(argv, sopt, lopt)
@@ -115,6 +126,28 @@ class ZpyZprOpts:
           sys.exit(2)
       elif o in ('-c', '--stdin'):
         self.stdin = True
+      elif o in ('-L', '--latency'):
+        self.latency = float(a)
+      elif o == '--lines':
+        self.lines = True
+      elif o == '--pin':
+        if a not in ('cpu', 'numa'):
+          sys.stderr.write('--pin must be cpu or numa' + os.linesep)
+          sys.exit(2)
+        self.pin = a
+      elif o == '--nice':
+        self.nice = int(a)
+      elif o == '--ionice':
+        self.ionice = a
+      elif o == '--journal':
+        self.journal = True
+      elif o == '--resume':
+        self.journal = True
+        self.resume = True
+
+    if self.stdin and self.journal:
+      sys.stderr.write('Cannot journal or resume when reading from standard input' + os.linesep)
+      sys.exit(2)
     
     if not self.stdin and (len(args) < 1 or len(args) > 2):
       sys.stderr.write('Wrong number of arguments passed.' + os.linesep)
@@ -142,7 +175,11 @@ class ZpyZprOpts:
         self.usage(True)
         sys.exit(2)
 
-      if os.path.exists(self.destination):
+      if self.journal:
+        self.journal = self.destination + '.journal'
+
+      # only a run with a journal to pick up from may reuse the destination
+      if os.path.exists(self.destination) and not (self.resume and os.path.exists(self.journal)):
         sys.stderr.write('Destination file (%s) already exists!%s' % (self.destination, os.linesep))
         self.usage(True)
         sys.exit(2)
@@ -181,12 +218,20 @@ class ZpyZprOpts:
     p('                     -1 -2 .. -9'+e)
     p('-c --stdin         Read from standard input, output to standard out'+e)
     p('-h --help          Prints this message'+e)
+    p('   --ionice=       I/O scheduling class for reading and writing (1 realtime, 2 best-effort, 3 idle)'+e)
+    p('   --journal       Record a checkpoint in <destinationfile>.journal after each block'+e)
     p('-j --bzip2         Use bzip2 compression'+e)
     p('                     '+bzip_enabled+e)
     p('-k --keep          Keep source files (The original source and intermediate slices)'+e)
     p('-l --lzip          Use lzip compression'+e)
     p('                     '+lzip_enabled+e)
-    p('-t --threads=      Specify the number compression threads (Default: 4)'+e)
+    p('-L --latency=      Close a block after this many seconds and write each piece as it completes'+e)
+    p('   --lines         With --latency only close short blocks at a newline'+e)
+    p('   --nice=         Niceness increment for the compression threads'+e)
+    p('   --pin=          Pin each compression thread to its own cpu or NUMA node (cpu, numa)'+e)
+    p('   --resume        Continue an interrupted --journal run from its last checkpoint'+e)
+    p('-t --threads=      Specify the number compression threads'+e)
+    p('                     (Default: cpus allowed by affinity and cgroup quota)'+e)
     p('-T --timing        Prints timings only'+e)
     p('-z --gzip          Use gzip compression (Default)'+e)
     p('                     '+gzip_enabled+e)
@@ -196,23 +241,80 @@ class ZpyZprOpts:
 if __name__ == '__main__':
   opts = ZpyZprOpts(sys.argv[1:])
 
+  (input_offset, output_offset) = (0, 0)
+  if opts.resume and os.path.exists(opts.destination):
+    (input_offset, output_offset) = read_checkpoint(opts.journal)
+    if os.path.getsize(opts.destination) < output_offset:
+      (input_offset, output_offset) = (0, 0)
+
+  journal = None
+  if opts.journal:
+    # start a fresh journal so a torn last entry can't linger, but swap it in
+    # with a rename so a valid checkpoint is on disk at every moment
+    tmp = open(opts.journal + '.tmp', 'wb')
+    tmp.write('%d %d\n' % (input_offset, output_offset))
+    tmp.flush()
+    os.fsync(tmp.fileno())
+    tmp.close()
+    os.rename(opts.journal + '.tmp', opts.journal)
+    try:
+      fd = os.open(os.path.dirname(os.path.abspath(opts.journal)), os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    except OSError:
+      pass
+    journal = open(opts.journal, 'ab')
+
   zz = opts.worker(threads=opts.threads,
                    block_size=opts.blocks,
                    debug=opts.verbose,
-                   logger=sys.stderr)
+                   logger=sys.stderr,
+                   max_latency=opts.latency,
+                   line_blocks=opts.lines,
+                   pin=opts.pin,
+                   nice=opts.nice,
+                   journal=journal,
+                   input_offset=input_offset,
+                   output_offset=output_offset)
+
+  if opts.ionice:
+    try:
+      subprocess.call(['ionice', '-c', opts.ionice, '-p', str(os.getpid())])
+    except OSError, ex:
+      zz.log(True, 'Unable to set I/O priority: %s' % ex)
 
   try:
     zz.log(opts.timing, 'Beginning Compression using %s (%d Threads)' % (MULTIPROCESSING, opts.threads))
     begin = datetime.now()
 
-    source = open(opts.source, 'rb')
-    destin = open(opts.destination, 'wb')
+    if opts.stdin:
+      source = sys.stdin
+      destin = os.fdopen(sys.stdout.fileno(), 'wb', WRITE_BUFFER_BYTES)
+    elif output_offset:
+      zz.log(opts.timing, 'Resuming at input offset %d, output offset %d' % (input_offset, output_offset))
+      source = open(opts.source, 'rb')
+      source.seek(input_offset)
+      destin = open(opts.destination, 'r+b', WRITE_BUFFER_BYTES)
+      destin.truncate(output_offset)
+      destin.seek(output_offset)
+    else:
+      source = open(opts.source, 'rb')
+      destin = open(opts.destination, 'wb', WRITE_BUFFER_BYTES)
+
+    # latency bounded reads need the descriptor itself
+    if not opts.latency: source = ReadAhead(source)
 
     zz.compressStream(source, destin)
     zz.flush()
     source.close()
     destin.close()
 
+    if journal:
+      journal.close()
+      os.remove(opts.journal)
+
     if not opts.stdin and not opts.keep: os.remove(opts.source)
 
     end = datetime.now()
@@ -220,7 +322,11 @@ if __name__ == '__main__':
 
   except Exception, ex:
     zz.flush(err=True)
-    if not opts.stdin:
+    if journal:
+      # keep the finished members around for --resume
+      destin.close()
+      journal.close()
+    elif not opts.stdin:
       destin.close()
       os.remove(opts.destination)
 